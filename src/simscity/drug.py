@@ -5,9 +5,15 @@ import numpy as np
 import scipy.special as ssp
 
 import simscity.latent
+import simscity.util
 
 
-def projection(n_latent: int, sparsity: float, scale: int | float) -> np.ndarray:
+def projection(
+    n_latent: int,
+    sparsity: float,
+    scale: int | float,
+    rng: int | np.random.Generator | None = None,
+) -> np.ndarray:
     """Generates a linear weighting from a latent space to feature space,
     potentially with some coefficients set to zero. Returns the weighting.
 
@@ -17,35 +23,54 @@ def projection(n_latent: int, sparsity: float, scale: int | float) -> np.ndarray
     :param scale: scaling factor for program weighting. If an array
                   of size ``(n_latent,)`` is given, different values are used
                   for each of the programs
+    :param rng: random number generator or seed, see ``simscity.util.get_rng``
     :return: array of shape (n_latent,) with weighting
     """
+    rng = simscity.util.get_rng(rng)
+
+    # every program is used, so there is no mask to sample
+    if np.isscalar(sparsity) and sparsity == 1.0:
+        return rng.normal(loc=0.0, scale=scale, size=n_latent)
 
     z_weights = simscity.latent.gen_weighting(
-        n_latent, 1, sparsity=sparsity, scale=scale
+        n_latent, 1, sparsity=sparsity, scale=scale, rng=rng
     ).flatten()
 
     return z_weights
 
 
-def doses(scale: int | float, n_conditions: int) -> np.ndarray:
+def doses(
+    scale: int | float,
+    n_conditions: int,
+    noise: bool = True,
+    rng: int | np.random.Generator | None = None,
+) -> np.ndarray:
     """
     Generates an array of uniformly-spaced values with a bit of random noise
     added in.
 
     :param scale: scale of the expected drug response data
     :param n_conditions: number of conditions (doses) desired
+    :param noise: if False, return the uniformly-spaced values with no noise
+    :param rng: random number generator or seed, see ``simscity.util.get_rng``
     :return: array shape (n_conditions,) with thresholds
     """
 
-    dose_thresholds = np.linspace(
-        -3 * scale, 3 * scale, n_conditions
-    ) + np.random.normal(size=n_conditions, scale=1.0 / (n_conditions**2))
+    dose_thresholds = np.linspace(-3 * scale, 3 * scale, n_conditions)
+
+    if noise:
+        dose_thresholds += simscity.util.get_rng(rng).normal(
+            size=n_conditions, scale=1.0 / (n_conditions**2)
+        )
 
     return dose_thresholds
 
 
 def response(
-    latent_exp: np.ndarray, z_weights: np.ndarray, doses: np.ndarray
+    latent_exp: np.ndarray,
+    z_weights: np.ndarray,
+    doses: np.ndarray,
+    dtype: np.dtype = np.float32,
 ) -> np.ndarray:
     """Given an array of samples from a latent space, the weighting for a drug,
     and the dose thresholds, this calculates the expected outcome for each
@@ -54,7 +79,14 @@ def response(
     :param latent_exp: array of samples with shape (n_samples, n_latent)
     :param z_weights: (n_latent,) weights for projection into the drug space
     :param doses: (n_conditions,) array of dose thresholds
+    :param dtype: floating-point type used for the calculation and the output
     :return: (n_samples, n_conditions) array of outcomes
     """
+    latent_exp = np.asarray(latent_exp, dtype=dtype)
+    z_weights = np.asarray(z_weights, dtype=dtype)
+    doses = np.asarray(doses, dtype=dtype)
+
+    # build the logits in a single output buffer and apply the sigmoid in-place
+    outcomes = np.add.outer(np.dot(latent_exp, z_weights), doses)
 
-    return ssp.expit(np.dot(latent_exp, z_weights)[..., None] + doses)
+    return ssp.expit(outcomes, out=outcomes)
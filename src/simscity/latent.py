@@ -8,7 +8,11 @@ import numpy as np
 
 
 def gen_weighting(
-    n_rows: int, n_cols: int, sparsity: np.ndarray, scale: np.ndarray
+    n_rows: int,
+    n_cols: int,
+    sparsity: np.ndarray,
+    scale: np.ndarray,
+    rng: np.random.Generator | None = None,
 ) -> np.ndarray:
     """Generic function to generate a random weighting. Can be used to create
     a random projection from one space to another
@@ -20,15 +24,21 @@ def gen_weighting(
                      If shape is (n_rows, 1) the values will apply to each row.
     :param scale: standard deviation of the weights. The rules for shape are the
                   same as for ``sparsity``
+    :param rng: random number generator. If None, the global numpy random state is
+                used
     :return: array of shape (n_rows, n_cols)
     """
     if np.any(sparsity <= 0) or np.any(sparsity > 1):
         raise ValueError("Sparsity should be in the interval (0, 1]")
 
+    # the legacy np.random functions share their signatures with Generator
+    if rng is None:
+        rng = np.random
+
     # fmt: off
     weights = (
-        (np.random.random(size=(n_rows, n_cols)) < sparsity)
-        * np.random.normal(loc=0.0, scale=scale, size=(n_rows, n_cols))
+        (rng.random(size=(n_rows, n_cols)) < sparsity)
+        * rng.normal(loc=0.0, scale=scale, size=(n_rows, n_cols))
     )
     # fmt: on
 
@@ -1,12 +1,33 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+import functools
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable
 
 import numpy as np
 import scipy.sparse as sp
+import scipy.special as ssp
 import scipy.stats as st
 
+import simscity.util
+
+# number of dense entries sampled at once when building a sparse umi matrix
+_SPARSE_BLOCK_ENTRIES = 2**22
+
+
+@functools.lru_cache(maxsize=32)
+def _truncation_cdf(lower_bound: float, upper_bound: float) -> tuple[float, float, int]:
+    """Standard normal CDF at the truncation bounds, cached because the bounds
+    rarely change between calls to ``library_size``. A truncation in the upper
+    tail is mirrored into the lower tail, where ``ndtr`` keeps its precision,
+    and the sign to undo the mirroring is returned with the endpoints"""
+    if lower_bound > 0:
+        return float(ssp.ndtr(-upper_bound)), float(ssp.ndtr(-lower_bound)), -1
+
+    return float(ssp.ndtr(lower_bound)), float(ssp.ndtr(upper_bound)), 1
+
 
 def library_size(
     n_cells: int,
@@ -14,6 +35,7 @@ def library_size(
     scale: float = 0.5,
     lower_bound: float = -1.0,
     upper_bound: float = np.inf,
+    rng: int | np.random.Generator | None = None,
 ) -> np.ndarray:
     """log-normal noise for the number of umis per cell (with a lower bound to
     represent a minimum depth cutoff)
@@ -23,34 +45,233 @@ def library_size(
     :param scale: standard deviation
     :param lower_bound: lower bound relative to ``loc``
     :param upper_bound: upper bound relative to ``loc``
+    :param rng: random number generator or seed, see ``simscity.util.get_rng``
     :return: float array of shape (n_cells,) containing the library sizes
     """
 
-    return np.exp(
-        st.truncnorm.rvs(lower_bound, upper_bound, loc=loc, scale=scale, size=n_cells)
-    ).astype(int)
+    # sample the truncated normal by inverting its CDF on uniform draws, which
+    # avoids the overhead of scipy.stats.truncnorm
+    rng = simscity.util.get_rng(rng)
+    # plain floats so the bounds are hashable for the cache, e.g. 0-d arrays
+    lower_bound, upper_bound = float(lower_bound), float(upper_bound)
+    cdf_lower, cdf_upper, sign = _truncation_cdf(lower_bound, upper_bound)
+
+    if cdf_lower < cdf_upper:
+        z = sign * ssp.ndtri(rng.uniform(cdf_lower, cdf_upper, size=n_cells))
+        # keep rounding error at the endpoints inside the truncation
+        z = np.clip(z, lower_bound, upper_bound)
+    else:
+        # the truncation is too far into the tail to be resolved by ndtr
+        z = st.truncnorm.rvs(lower_bound, upper_bound, size=n_cells, random_state=rng)
+
+    return np.exp(loc + scale * z).astype(int)
 
 
-def fragment_genes(n_genes: int, lam: float = 1.0) -> np.ndarray:
+def fragment_genes(
+    n_genes: int, lam: float = 1.0, rng: int | np.random.Generator | None = None
+) -> np.ndarray:
     """Generate a random number of fragments for each gene used a poisson distribution
 
     :param n_genes: number of genes to fragment
     :param lam: mean of poisson distribution of (additional) fragments. Every gene
                 will have at least one fragment
+    :param rng: random number generator or seed, see ``simscity.util.get_rng``
     :return: int array of shape (n_genes,) with number of fragments per gene
     """
     # random number of possible fragments per gene, poisson distributed
     # add one to ensure ≥1 fragment per gene
-    fragments_per_gene = 1 + np.random.poisson(lam, size=n_genes)
+    fragments_per_gene = 1 + simscity.util.get_rng(rng).poisson(lam, size=n_genes)
 
     return fragments_per_gene
 
 
+def _split_fragments(
+    gene_umis: np.ndarray,
+    fragments_per_gene: np.ndarray,
+    rng: np.random.Generator,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """Splits the umis of each gene uniformly among its fragments, which is
+    equivalent to sampling the fragments directly.
+
+    :param gene_umis: int array of shape ``(..., n_genes)`` of umi counts per gene
+    :param fragments_per_gene: int array of shape ``(n_genes,)``
+    :param rng: random number generator
+    :param out: optional int array of shape ``(..., n_fragments)`` to write into. It
+                is not used if every gene has a single fragment
+    :return: int array of shape ``(..., n_fragments)`` of umi counts per fragment
+    """
+    if np.all(fragments_per_gene == 1):
+        return gene_umis
+
+    if out is None:
+        fragment_umis = np.empty(
+            gene_umis.shape[:-1] + (fragments_per_gene.sum(),), dtype=gene_umis.dtype
+        )
+    else:
+        fragment_umis = out
+    offsets = np.cumsum(fragments_per_gene) - fragments_per_gene
+
+    # genes with the same number of fragments are split in one batched draw
+    for f in np.unique(fragments_per_gene):
+        genes = np.flatnonzero(fragments_per_gene == f)
+        if f == 1:
+            fragment_umis[..., offsets[genes]] = gene_umis[..., genes]
+        elif f > 1:
+            fragment_umis[..., offsets[genes, None] + np.arange(f)] = rng.multinomial(
+                gene_umis[..., genes], np.full(f, 1.0 / f)
+            )
+
+    return fragment_umis
+
+
+def _cupy_multinomial(n: np.ndarray, pvals: np.ndarray) -> np.ndarray:
+    """Batched multinomial sampling on the GPU. Each category is drawn as a
+    binomial conditioned on the counts already assigned, vectorized across
+    all of the cells at once.
+
+    :param n: int array of shape ``(...)`` with the number of trials per cell
+    :param pvals: array of shape ``(..., k)`` of probabilities per cell
+    :return: int array of shape ``(..., k)`` with the sampled counts
+    """
+    try:
+        import cupy as cp
+    except ImportError:
+        warnings.warn("the cupy backend requires cupy")
+        raise
+
+    pvals = cp.asarray(pvals)
+    remaining = cp.array(n, dtype=cp.int64)
+    q = cp.ones(remaining.shape)
+
+    counts = cp.empty(pvals.shape, dtype=cp.int64)
+    for j in range(pvals.shape[-1] - 1):
+        # probability of category j given that it wasn't one of the previous ones
+        p_j = cp.clip(pvals[..., j] / cp.maximum(q, np.finfo(np.float64).tiny), 0, 1)
+        counts[..., j] = cp.random.binomial(remaining, p_j)
+        remaining -= counts[..., j]
+        q -= pvals[..., j]
+    counts[..., -1] = remaining
+
+    return cp.asnumpy(counts)
+
+
+def _multinomial_chunk(
+    rng: np.random.Generator, n: np.ndarray, pvals: np.ndarray
+) -> np.ndarray:
+    """Batched multinomial draw for one chunk of cells, run in a worker process"""
+    return rng.multinomial(n=n, pvals=pvals)
+
+
+def _parallel_multinomial(
+    n: np.ndarray,
+    pvals: np.ndarray,
+    executor: ProcessPoolExecutor,
+    rng: np.random.Generator,
+    n_workers: int,
+) -> np.ndarray:
+    """Batched multinomial sampling with the cells split into one chunk per
+    worker. Each chunk is drawn from its own generator, spawned from ``rng``
+
+    :param n: int array of shape ``(...)`` with the number of trials per cell
+    :param pvals: array of shape ``(..., k)`` of probabilities per cell
+    :param executor: process pool to run the chunks in
+    :param rng: random number generator used to spawn one generator per chunk
+    :param n_workers: number of chunks to split the cells into
+    :return: int array of shape ``(..., k)`` with the sampled counts
+    """
+    chunks = executor.map(
+        _multinomial_chunk,
+        rng.spawn(n_workers),
+        np.array_split(np.reshape(n, -1), n_workers),
+        np.array_split(pvals.reshape(-1, pvals.shape[-1]), n_workers),
+    )
+
+    return np.concatenate(list(chunks)).reshape(pvals.shape)
+
+
+def _sample_umis(
+    lib_size: np.ndarray,
+    gene_p: np.ndarray,
+    fragments_per_gene: np.ndarray,
+    multinomial: Callable[..., np.ndarray],
+    rng: np.random.Generator,
+    sparse: bool,
+) -> np.ndarray | sp.csr_matrix:
+    """Samples the umi counts for ``umi_counts``, given the normalized gene-level
+    probabilities and a batched multinomial sampler
+
+    :param lib_size: int array of shape ``(...)`` with the library size per cell
+    :param gene_p: array of shape ``(..., n_genes)`` of probabilities per cell
+    :param fragments_per_gene: int array of shape ``(n_genes,)``
+    :param multinomial: function taking ``n`` and ``pvals`` arrays and returning a
+                        batched multinomial draw
+    :param rng: random number generator for splitting counts among fragments
+    :param sparse: if True, return a 2-d sparse (CSR) matrix
+    :return: integer array of shape ``(..., n_fragments)`` containing umi counts
+    """
+    n_genes = gene_p.shape[-1]
+
+    if sparse:
+        # sample a block of cells at a time so that only one dense block is in
+        # memory, keeping just its nonzero entries for a single CSR matrix
+        lib_size = lib_size.reshape(-1)
+        gene_p = gene_p.reshape(-1, n_genes)
+        n_fragments = fragments_per_gene.sum()
+        block_size = min(max(1, _SPARSE_BLOCK_ENTRIES // n_fragments), gene_p.shape[0])
+
+        # the split fragment counts for every block are written into one buffer,
+        # which isn't needed if no gene is split
+        if np.any(fragments_per_gene != 1):
+            block_out = np.empty((block_size, n_fragments), dtype=np.int64)
+        else:
+            block_out = None
+
+        data, indices, nnz_per_cell = [], [], []
+        for i in range(0, gene_p.shape[0], block_size):
+            gene_umis = multinomial(
+                n=lib_size[i : i + block_size], pvals=gene_p[i : i + block_size]
+            )
+            block = _split_fragments(
+                gene_umis,
+                fragments_per_gene,
+                rng,
+                out=None if block_out is None else block_out[: len(gene_umis)],
+            )
+            rows, cols = block.nonzero()
+            data.append(block[rows, cols])
+            indices.append(cols)
+            nnz_per_cell.append(np.count_nonzero(block, axis=1))
+
+        indptr = np.concatenate([[0], np.cumsum(np.concatenate(nnz_per_cell))])
+
+        cell_gene_umis = sp.csr_matrix(
+            (np.concatenate(data), np.concatenate(indices), indptr),
+            shape=(gene_p.shape[0], n_fragments),
+        )
+    else:
+        # the dense output is n_fragments wide regardless, so splitting the gene
+        # counts would only add draws: sample the fragments directly instead
+        if np.any(fragments_per_gene != 1):
+            gene_p = np.repeat(gene_p, fragments_per_gene, axis=-1) / np.repeat(
+                fragments_per_gene, fragments_per_gene
+            )
+
+        # a single batched draw, broadcasting the per-cell library sizes over the
+        # leading dimensions of gene_p
+        cell_gene_umis = multinomial(n=lib_size, pvals=gene_p)
+
+    return cell_gene_umis
+
+
 def umi_counts(
     raw_expression: np.ndarray,
     lib_size: int | np.ndarray[int] = None,
     fragments_per_gene: int | np.ndarray[int] = 1,
     sparse: bool = False,
+    backend: str = "numpy",
+    rng: int | np.random.Generator | None = None,
+    n_workers: int = 1,
 ) -> np.ndarray:
     """Given an ``(..., n_genes)`` array of expression values, generates a count matrix
     of UMIs based by multinomial sampling. The last dimension of the array defines
@@ -63,6 +284,17 @@ def umi_counts(
     :param fragments_per_gene: fragments observed per gene, either constant or per-gene
     :param sparse: if True, return a sparse (CSR) matrix. If ``raw_expression`` is >2-d,
                    the output matrix will be reshaped to 2-d
+    :param backend: either "numpy", or "cupy" to sample the gene counts on the GPU,
+                    which can be much faster for a large number of cells. The
+                    gene counts are then drawn from cupy's own random state
+    :param rng: random number generator or seed, see ``simscity.util.get_rng``
+    :param n_workers: number of processes to split the cells across when sampling
+                      with the numpy backend. Each process draws from its own
+                      generator, spawned from ``rng``. The probabilities and
+                      counts are pickled to and from the workers, so this only
+                      helps with several cores and when sampling (roughly
+                      proportional to the number of cells times genes) costs
+                      more than that transfer. The default of 1 samples in-process
     :return: integer array of shape ``(..., n_features)`` containing umi counts
     """
 
@@ -72,40 +304,106 @@ def umi_counts(
     if len(raw_expression.shape) == 1:
         raise ValueError("raw_expression should be >= 2 dimensions")
 
+    if backend not in ("numpy", "cupy"):
+        raise ValueError(f"Unknown backend {backend!r}, expected 'numpy' or 'cupy'")
+
     if sparse and len(raw_expression.shape) > 2:
         warnings.warn("Reshaping output to 2 dimensions for sparse matrix")
 
     n_cells = raw_expression.shape[:-1]
     n_genes = raw_expression.shape[-1]
 
+    rng = simscity.util.get_rng(rng)
+
     if lib_size is None:
-        lib_size = library_size(n_cells)  # is this a good default?
+        lib_size = library_size(n_cells, rng=rng)  # is this a good default?
     else:
-        lib_size = np.broadcast_to(lib_size, n_cells)
+        # the multinomial samplers require integer trials, e.g. for lib_size=1e4
+        lib_size = np.broadcast_to(
+            np.asarray(lib_size).astype(np.int64, copy=False), n_cells
+        )
 
     fragments_per_gene = np.broadcast_to(fragments_per_gene, (n_genes,))
 
-    # each fragment is at the level of the gene it comes from
-    fragment_expression = np.repeat(raw_expression, fragments_per_gene, axis=-1)
+    # each fragment is at the level of the gene it comes from, so a gene is
+    # sampled in proportion to its expression times its number of fragments.
+    # the multinomial sampler reads each cell's probabilities as a contiguous
+    # float64 row, so lay them out that way once here and normalize in-place
+    gene_p = np.multiply(
+        raw_expression, fragments_per_gene, dtype=np.float64, order="C"
+    )
+    gene_p /= gene_p.sum(-1, keepdims=True)
+
+    if backend == "cupy":
+        multinomial = _cupy_multinomial
+    elif n_workers > 1:
+        with ProcessPoolExecutor(n_workers) as executor:
+            multinomial = functools.partial(
+                _parallel_multinomial, executor=executor, rng=rng, n_workers=n_workers
+            )
+            return _sample_umis(
+                lib_size, gene_p, fragments_per_gene, multinomial, rng, sparse
+            )
+    else:
+        multinomial = rng.multinomial
 
-    gene_p = fragment_expression / fragment_expression.sum(-1, keepdims=True)
+    return _sample_umis(lib_size, gene_p, fragments_per_gene, multinomial, rng, sparse)
 
-    if sparse:
-        cell_gene_umis = sp.vstack(
-            [
-                sp.csr_matrix(np.random.multinomial(n=lib_size[i], pvals=gene_p[i]))
-                for i in np.ndindex(*n_cells)
-            ]
-        )
-    else:
-        cell_gene_umis = np.vstack(
-            [
-                np.random.multinomial(n=lib_size[i], pvals=gene_p[i])
-                for i in np.ndindex(*n_cells)
-            ]
-        ).reshape(*n_cells, -1)
 
-    return cell_gene_umis
+def _approx_binomial_step(
+    d: np.ndarray,
+    pcr_betas: float | np.ndarray,
+    normal_threshold: float,
+    rng: np.random.Generator,
+) -> None:
+    """Adds a binomial(d, pcr_betas) draw to ``d`` in-place, using the normal
+    approximation for the entries where the variance exceeds ``normal_threshold``
+
+    :param d: 1-d int array of counts
+    :param pcr_betas: PCR efficiency, either constant or a 1-d array with the same
+                      shape as ``d``
+    :param normal_threshold: variance above which the normal approximation is used
+    :param rng: random number generator
+    """
+    pcr_betas = np.broadcast_to(pcr_betas, d.shape)
+
+    mean = d * pcr_betas
+    var = mean * (1 - pcr_betas)
+    large = var > normal_threshold
+
+    if not np.any(large):
+        d += rng.binomial(n=d, p=pcr_betas)
+        return
+
+    if np.all(large):
+        d += _rounded_normal(d, mean, var, rng)
+        return
+
+    small = ~large
+    d[small] += rng.binomial(n=d[small], p=pcr_betas[small])
+    d[large] += _rounded_normal(d[large], mean[large], var[large], rng)
+
+
+def _rounded_normal(
+    d: np.ndarray, mean: np.ndarray, var: np.ndarray, rng: np.random.Generator
+) -> np.ndarray:
+    """Normal approximation to a binomial draw, rounded and clipped to the
+    support ``[0, d]``"""
+    return np.clip(np.rint(rng.normal(loc=mean, scale=np.sqrt(var))), 0, d).astype(
+        d.dtype
+    )
+
+
+def _stored_columns(read_counts: sp.spmatrix) -> np.ndarray:
+    """Column index of each value in ``read_counts.data``, for a CSR, CSC or COO
+    matrix. Unlike ``.nonzero()``, this includes explicitly stored zeros and
+    follows the storage order of ``.data``"""
+    if read_counts.format == "csr":
+        return read_counts.indices
+    elif read_counts.format == "csc":
+        return np.repeat(np.arange(read_counts.shape[1]), np.diff(read_counts.indptr))
+    else:
+        return read_counts.col
 
 
 def pcr_noise(
@@ -113,37 +411,70 @@ def pcr_noise(
     pcr_betas: float | np.ndarray[float],
     n_cycles: int,
     copy: bool = True,
+    normal_threshold: float | None = None,
+    rng: int | np.random.Generator | None = None,
 ) -> np.ndarray:
     """PCR noise model: every read has an affinity for PCR, and for every round
     of PCR we do a ~binomial doubling of each count.
 
     :param read_counts: array of shape (n_samples, n_features) representing unique
                         molecules (e.g. genes or gene fragments). If a sparse matrix
-                        is provided, the output will be sparse
+                        is provided, the output will be sparse. CSR, CSC and COO
+                        matrices keep their format, others are converted to CSR
     :param pcr_betas: PCR efficiency for each feature, either constant or per-feature
     :param n_cycles: number of rounds of PCR to simulate
     :param copy: if True, return a copy of the read_counts array, else modify in-place
+                 (not possible for sparse formats other than CSR, CSC and COO)
+    :param normal_threshold: if given, counts whose binomial variance exceeds this
+                             value (e.g. 30) are amplified using a rounded normal
+                             approximation, which is much faster for large counts
+    :param rng: random number generator or seed, see ``simscity.util.get_rng``
     :return: int array of shape (n_samples, n_features) with amplified counts
     """
+    rng = simscity.util.get_rng(rng)
+    pcr_betas = np.asarray(pcr_betas, dtype=np.float64)
+
     if np.any(pcr_betas < 0):
         raise ValueError("pcr_betas must be non-negative")
 
     if copy:
         read_counts = read_counts.copy()
 
-    pcr_betas = np.broadcast_to(pcr_betas, (1, read_counts.shape[1]))
+    if sp.issparse(read_counts) and read_counts.format not in ("csr", "csc", "coo"):
+        if not copy:
+            warnings.warn(
+                f"pcr_noise can't modify {read_counts.format} matrices in-place,"
+                " converting to CSR"
+            )
+        read_counts = read_counts.tocsr()
 
+    # zero counts are never amplified, so only the nonzero entries are sampled.
+    # they are gathered once and updated in place for all cycles
     if sp.issparse(read_counts):
-        d = read_counts.data[None, :]
-        pcr_betas = pcr_betas[:, read_counts.nonzero()[1]]
+        d = read_counts.data
+        cols = _stored_columns(read_counts)
+    else:
+        nz = read_counts.nonzero()
+        d = read_counts[nz]
+        cols = nz[1]
+
+    # a constant efficiency is left as a scalar for binomial to broadcast,
+    # otherwise gather a 1-d array with the efficiency for each entry of d
+    if pcr_betas.size > 1:
+        pcr_betas = np.broadcast_to(pcr_betas.ravel(), (read_counts.shape[1],))[cols]
     else:
-        d = read_counts
+        pcr_betas = pcr_betas.item()
 
     # for each round of pcr, each gene increases according to its affinity factor
     for i in range(n_cycles):
-        d += np.random.binomial(n=d, p=pcr_betas, size=d.shape)
+        if normal_threshold is None:
+            d += rng.binomial(n=d, p=pcr_betas)
+        else:
+            _approx_binomial_step(d, pcr_betas, normal_threshold, rng)
 
     if sp.issparse(read_counts):
-        read_counts.data = d.flatten()
+        read_counts.data = d
+    else:
+        read_counts[nz] = d
 
     return read_counts
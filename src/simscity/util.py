@@ -5,6 +5,23 @@ import warnings
 
 import numpy as np
 
+# shared generator for functions that are not given one
+_rng = np.random.default_rng()
+
+
+def get_rng(rng: int | np.random.Generator | None = None) -> np.random.Generator:
+    """Returns the random number generator to use for a simulation function
+
+    :param rng: a Generator, or a seed (or anything else accepted by
+                ``np.random.default_rng``). If None, a shared module-level
+                Generator is used
+    :return: a numpy Generator
+    """
+    if rng is None:
+        return _rng
+
+    return np.random.default_rng(rng)
+
 
 def arrays_to_anndata(
     expression: np.ndarray, batch: np.ndarray, classes=np.ndarray, **obsm: np.ndarray
@@ -24,9 +41,9 @@ def arrays_to_anndata(
         warnings.warn("arrays_to_anndata requires anndata")
         raise
 
-    metadata = pd.DataFrame({"batch": batch, "class": classes})
-    metadata["batch"] = metadata["batch"].astype("category")
-    metadata["class"] = metadata["class"].astype("category")
+    metadata = pd.DataFrame(
+        {"batch": pd.Categorical(batch), "class": pd.Categorical(classes)}
+    )
 
     adata = anndata.AnnData(X=expression, obs=metadata, obsm=(obsm or None))
 